@@ -0,0 +1,23 @@
+# gunicorn -c gunicorn.conf.py
+import multiprocessing
+import os
+from dotenv import load_dotenv
+
+# REDIS_URL usually comes from .env, which the app itself only loads inside each worker
+load_dotenv()
+
+wsgi_app = "whatsapp-flask-server:app"
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# gevent patches sockets, so requests/redis calls yield instead of blocking a worker
+worker_class = "gevent"
+# Without Redis each worker keeps its own in-process sessions, and a user whose messages landed
+# on different workers would bounce between conversation states, so only one worker runs then
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count())) if os.getenv("REDIS_URL") else 1
+worker_connections = 1000
+# Workers split WHATSAPP_MESSAGES_PER_SECOND between them, so they need to know how many there are
+raw_env = [f"WEB_CONCURRENCY={workers}"]
+
+# gevent must patch the stdlib before the app imports requests/ssl and starts its
+# worker thread, so each worker imports the app itself instead of preloading it
+preload_app = False
@@ -0,0 +1,62 @@
+import importlib.util
+import json
+import logging
+import os
+import unittest
+from unittest import mock
+
+import requests
+
+os.environ.setdefault("WHATSAPP_API_TOKEN", "test-token")
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "whatsapp-flask-server.py")
+spec = importlib.util.spec_from_file_location("whatsapp_flask_server", SERVER_PATH)
+server = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(server)
+
+ALICE = "15550001111"
+BOB = "15550002222"
+
+
+def delivery(*messages):
+    return {"entry": [{"changes": [{"value": {"messages": [
+        {"from": sender, "type": "text", "text": {"body": text}} for sender, text in messages]}}]}]}
+
+
+class OutboxGroupingTest(unittest.TestCase):
+    def setUp(self):
+        self.posts = []
+        server.user_sessions.clear()
+        # Send from the calling thread so every POST has happened when process_deliveries returns
+        patcher = mock.patch.object(server, "PROCESS_INLINE", True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(server.SESSION, "post", side_effect=self.fake_post)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fake_post(self, url, data=None, **kwargs):
+        messages = json.loads(data)["messages"]
+        self.posts.append(messages)
+        response = requests.Response()
+        response.url = url
+        # Heltar rejects anything addressed to Bob
+        response.status_code = 400 if any(m["clientWaNumber"] == BOB for m in messages) else 200
+        return response
+
+    def test_each_delivery_sends_one_request_per_recipient(self):
+        with self.assertLogs(server.logger, level=logging.ERROR) as logs:
+            server.process_deliveries([
+                delivery((ALICE, "hi"), (BOB, "hi")),
+                delivery((ALICE, "hello")),
+            ])
+
+        recipients = [{m["clientWaNumber"] for m in messages} for messages in self.posts]
+        self.assertEqual(recipients, [{ALICE}, {BOB}, {ALICE}])
+        # Only Bob's request failed; both of Alice's replies still went out
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn(BOB, logs.records[0].getMessage())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import importlib.util
+import logging
+import os
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.environ.setdefault("WHATSAPP_API_TOKEN", "test-token")
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "whatsapp-flask-server.py")
+spec = importlib.util.spec_from_file_location("whatsapp_flask_server", SERVER_PATH)
+server = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(server)
+
+
+class SlowHeltarHandler(BaseHTTPRequestHandler):
+    posts = []
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.posts.append(self.path)
+        time.sleep(1)
+        try:
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"{}")
+        except OSError:
+            pass # The client has already given up
+
+    def log_message(self, *args):
+        pass
+
+
+class SendTimeoutTest(unittest.TestCase):
+    def setUp(self):
+        SlowHeltarHandler.posts = []
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), SlowHeltarHandler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+        # Same adapter and retry policy as production, pointed at the local server
+        server.SESSION.mount("http://", server.SESSION.get_adapter("https://api.heltar.com"))
+        self.addCleanup(server.SESSION.adapters.pop, "http://")
+        self.addCleanup(self.httpd.shutdown)
+        self.addCleanup(setattr, server, "WHATSAPP_API_URL", server.WHATSAPP_API_URL)
+        self.addCleanup(setattr, server, "WHATSAPP_API_TIMEOUT", server.WHATSAPP_API_TIMEOUT)
+        server.WHATSAPP_API_URL = f"http://127.0.0.1:{self.httpd.server_port}/"
+        server.WHATSAPP_API_TIMEOUT = (1, 0.2)
+
+    def test_read_timeout_is_sent_once_and_logged_as_warning(self):
+        with self.assertLogs(server.logger, level=logging.WARNING) as logs:
+            result = server.send_whatsapp_message(b'{"messages":[]}', "15550001111")
+
+        self.assertEqual(result["status"], "error")
+        self.assertEqual(len(SlowHeltarHandler.posts), 1)
+        self.assertEqual([record.levelno for record in logs.records], [logging.WARNING])
+        self.assertIn("Timed out", logs.records[0].getMessage())
+
+
+if __name__ == "__main__":
+    unittest.main()
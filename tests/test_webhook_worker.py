@@ -0,0 +1,85 @@
+import importlib.util
+import os
+import threading
+import unittest
+from unittest import mock
+
+import requests
+
+os.environ.setdefault("WHATSAPP_API_TOKEN", "test-token")
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "whatsapp-flask-server.py")
+
+
+def load_server():
+    spec = importlib.util.spec_from_file_location("whatsapp_flask_server", SERVER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+server = load_server()
+
+
+def delivery(sender, text="hi"):
+    return {"entry": [{"changes": [{"value": {"messages": [
+        {"from": sender, "type": "text", "text": {"body": text}}]}}]}]}
+
+
+def ok_response(url):
+    response = requests.Response()
+    response.url = url
+    response.status_code = 200
+    return response
+
+
+class WebhookWorkerTest(unittest.TestCase):
+    def setUp(self):
+        server.user_sessions.clear()
+
+    def test_queued_delivery_is_processed(self):
+        sent = threading.Event()
+        with mock.patch.object(server.SESSION, "post",
+                               side_effect=lambda url, **kwargs: sent.set() or ok_response(url)) as post:
+            response = server.app.test_client().post("/webhook", json=delivery("15550001111"))
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(sent.wait(5))
+
+        self.assertIn(b"15550001111", post.call_args.kwargs["data"])
+
+    def test_stop_drains_deliveries_queued_ahead_of_it(self):
+        processed = []
+        self.addCleanup(server.start_webhook_worker)
+        with mock.patch.object(server, "process_deliveries", side_effect=processed.extend):
+            for sender in ("15550001111", "15550002222", "15550003333"):
+                server.WEBHOOK_QUEUE.put(delivery(sender))
+            server.stop_webhook_worker()
+
+        self.assertFalse(server.webhook_worker.is_alive())
+        self.assertEqual([data["entry"][0]["changes"][0]["value"]["messages"][0]["from"] for data in processed],
+                         ["15550001111", "15550002222", "15550003333"])
+
+
+class InlineWebhookTest(unittest.TestCase):
+    def setUp(self):
+        # PROCESS_INLINE is read at import time, so Vercel mode needs its own module instance
+        with mock.patch.dict(os.environ, {"VERCEL": "1"}):
+            self.server = load_server()
+
+    def test_reply_is_sent_before_the_view_returns(self):
+        senders = []
+
+        def fake_post(url, **kwargs):
+            senders.append(threading.current_thread())
+            return ok_response(url)
+
+        with mock.patch.object(self.server.SESSION, "post", side_effect=fake_post):
+            response = self.server.app.test_client().post("/webhook", json=delivery("15550001111"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(self.server.webhook_worker)
+        self.assertEqual(senders, [threading.current_thread()])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,51 +1,183 @@
 import os
-import json
+import re
+import atexit
 import requests
+import redis
 import logging
-import uuid
-from datetime import datetime, timedelta
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Fastest available JSON codec, chosen once at import. _dumps always returns compact UTF-8 bytes.
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+
+        def _dumps(obj):
+            return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode()
+        _loads = ujson.loads
+    except ImportError:
+        import json
+
+        def _dumps(obj):
+            return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+        _loads = json.loads
 
 load_dotenv()
 
+class FastJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return _dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return _loads(s)
+
+    def response(self, *args, **kwargs):
+        # jsonify() body straight from the encoded bytes, skipping the str round-trip.
+        # Same argument rules as jsonify(): one positional value, several as a list, or kwargs.
+        if args and kwargs:
+            raise TypeError("jsonify() takes either args or kwargs, not both")
+        obj = args[0] if len(args) == 1 else (list(args) or kwargs or None)
+        return self._app.response_class(_dumps(obj), mimetype=self.mimetype)
+
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 app.config['SECRET_KEY'] = os.getenv("SECRET_KEY", "a_default_secret_key_for_dev")
+# Heltar webhook bodies are a few KB; oversized ones get a 413 before they are read
+app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024
 
-logging.basicConfig(level=logging.INFO)
+# Production deployments set LOG_LEVEL=WARNING to skip the per-message info lines
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
 WHATSAPP_API_URL = "https://api.heltar.com/v1/messages/send"
 WHATSAPP_API_TOKEN = os.getenv("WHATSAPP_API_TOKEN")
-
-# !! Replace this with Redis client !!
-user_sessions = {} # This will be replaced by Redis interaction
+WHATSAPP_API_TIMEOUT = (3.05, 10) # (connect, read) seconds; connect just over one SYN retransmit
+MAX_MESSAGES_PER_REQUEST = 50
+WHATSAPP_MESSAGES_PER_SECOND = int(os.getenv("WHATSAPP_MESSAGES_PER_SECOND", 500))
+# Number of server processes sharing that limit; gunicorn.conf.py exports its worker count here
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))
+# Built once; the token does not change at runtime
+HEADERS = {
+    "Content-Type": "application/json",
+    "Authorization": f"Bearer {WHATSAPP_API_TOKEN}"
+}
+
+# Sends are not idempotent, so only failures that show Heltar never took the message are retried:
+# connection errors, 429 (after its Retry-After) and 503. A read timeout or 502/504 may arrive after
+# the message was accepted, and read=False re-raises the ReadTimeout instead of posting it again.
+SEND_RETRY = Retry(total=3, read=False, backoff_factor=0.3,
+                   status_forcelist=(429, 503),
+                   allowed_methods=frozenset(["POST"]))
+
+# One pooled session for all outbound calls so keep-alive connections to Heltar are reused
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=50, pool_maxsize=50, max_retries=SEND_RETRY))
+SESSION.headers.update(HEADERS)
+
+# Vercel freezes a function once it has responded, so nothing may be left to run after the ack there
+PROCESS_INLINE = bool(os.getenv("VERCEL"))
+
+# Replies are sent from worker threads so the webhook can ack without waiting on Heltar
+EXECUTOR = ThreadPoolExecutor(max_workers=16)
+atexit.register(EXECUTOR.shutdown, wait=True)
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, count=1):
+        # Reserve the tokens under the lock, then sleep off any deficit outside it
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= count
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+# Heltar's limit is per account, so each process sends at an equal share of it and all of
+# them together stay under the limit during bursts
+SEND_RATE_LIMITER = TokenBucket(WHATSAPP_MESSAGES_PER_SECOND / WEB_CONCURRENCY)
+
+REDIS_URL = os.getenv("REDIS_URL")
+SESSION_TTL_SECONDS = 86400
+MAX_IN_MEMORY_SESSIONS = 100_000
+
+# Sessions are stored as Redis hashes so every worker/instance shares them.
+# Without REDIS_URL (local development) they fall back to this in-process LRU,
+# which mirrors Redis' TTL and drops the least recently used session when full.
+rds = None
+if REDIS_URL:
+    rds = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(
+        REDIS_URL, max_connections=64, decode_responses=True, socket_keepalive=True))
+user_sessions = OrderedDict()
+
+# Static reply content shared by every conversation; treat as read-only
+MENU_BUTTONS = (
+    {'id': 'menu_product_info', 'title': 'Product Information'},
+    {'id': 'menu_support', 'title': 'Customer Support'},
+    {'id': 'menu_order', 'title': 'Place an Order'}
+)
+FOLLOWUP_BUTTONS = (
+    {'id': 'prod_order_yes', 'title': 'Place Order'},
+    {'id': 'prod_order_no', 'title': 'Back to Menu'}
+)
+PRODUCT_SECTIONS = (
+    {
+        "title": "Our Products",
+        "rows": (
+            {'id': 'prod_A', 'title': 'Model A', 'description': 'High-end model - $299'},
+            {'id': 'prod_B', 'title': 'Model B', 'description': 'Mid-range model - $199'},
+            {'id': 'prod_C', 'title': 'Model C', 'description': 'Budget model - $99'}
+        )
+    },
+)
+PRODUCTS = {"prod_A": "Model A - $299", "prod_B": "Model B - $199", "prod_C": "Model C - $99"}
+INTERACTIVE_TYPES = frozenset(("button_reply", "list_reply"))
+MEDIA_TYPES = frozenset(("audio", "document", "image", "video"))
+HEADER_MEDIA_TYPES = frozenset(("image", "video", "document"))
+
+# "<product name> <quantity>", e.g. "Model A 2"
+ORDER_RE = re.compile(r'\s*(?P<name>.+?)\s+(?P<qty>\d+)\s*$')
+# A bare quantity, e.g. "3"
+QTY_RE = re.compile(r'\s*(?P<qty>\d+)\s*$')
 
 def create_text_payload(recipient_number, message_text):
     return {
-        "messages": [{
-            "clientWaNumber": recipient_number,
-            "message": message_text,
-            "messageType": "text"
-        }]
+        "clientWaNumber": recipient_number,
+        "message": message_text,
+        "messageType": "text"
     }
 
 def create_media_payload(recipient_number, media_type, media_url, file_name, mime_type):
-    if media_type not in ["audio", "document", "image", "video"]:
+    if media_type not in MEDIA_TYPES:
         raise ValueError("Invalid media type. Must be one of: audio, document, image, video")
     
     return {
-        "messages": [
-            {
-                "clientWaNumber": recipient_number,
-                "mediaType": media_type,
-                "url": media_url,
-                "name": file_name,
-                "size": 212732,
-                "mimeType": mime_type,
-                "messageType": "media"
-            }
-        ]
+        "clientWaNumber": recipient_number,
+        "mediaType": media_type,
+        "url": media_url,
+        "name": file_name,
+        "size": 212732,
+        "mimeType": mime_type,
+        "messageType": "media"
     }
 
 def create_contact_payload(recipient_number, formatted_name, phone_wa_id, prefix=None):
@@ -64,11 +196,9 @@ def create_contact_payload(recipient_number, formatted_name, phone_wa_id, prefix
         contact["name"]["prefix"] = prefix
 
     return {
-        "messages": [{
-            "clientWaNumber": recipient_number,
-            "messageType": "contacts",
-            "contacts": [contact]
-        }]
+        "clientWaNumber": recipient_number,
+        "messageType": "contacts",
+        "contacts": [contact]
     }
 
 def create_button_payload(recipient_number, body_text, buttons, header_text=None, header_media=None):
@@ -86,288 +216,492 @@ def create_button_payload(recipient_number, body_text, buttons, header_text=None
     elif header_media:
         media_type = header_media.get('type')
         link = header_media.get('link')
-        if media_type in ['image', 'video', 'document'] and link:
+        if media_type in HEADER_MEDIA_TYPES and link:
              interactive["header"] = {
                  "type": media_type,
                  media_type: {"link": link}
              }
         else:
-            logger.warning(f"Invalid header_media format: {header_media}")
+            logger.warning("Invalid header_media format: %s", header_media)
 
     return {
-         "messages": [{
-             "clientWaNumber": recipient_number,
-             "messageType": "interactive",
-             "interactive": interactive
-         }]
+        "clientWaNumber": recipient_number,
+        "messageType": "interactive",
+        "interactive": interactive
     }
 
 def create_list_payload(recipient_number, header_text, body_text, button_text, sections):
-    all_row_ids = set()
-    processed_sections = []
-    for section in sections:
-        processed_rows = []
-        for row in section.get("rows", []):
-            if row.get("id") in all_row_ids:
-                logger.warning(f"Duplicate row ID found and skipped: {row.get('id')}")
-                continue
-            all_row_ids.add(row.get("id"))
-            processed_rows.append(row)
-        if processed_rows:
-             processed_sections.append({"title": section.get("title", ""), "rows": processed_rows})
-
-    if not processed_sections:
+    # Sections come from code, not webhook input, so a missing key is a bug worth raising on
+    row_ids = [row["id"] for section in sections for row in section["rows"]]
+    if len(row_ids) == len(set(row_ids)):
+        # The usual case: nothing to drop, so the sections are sent as given
+        processed_sections = sections
+    else:
+        seen_rows = {} # row id -> row, across all sections
+        processed_sections = []
+        for section in sections:
+            rows = section["rows"]
+            processed_rows = [seen_rows.setdefault(row_id, row) for row in rows
+                              if (row_id := row["id"]) not in seen_rows]
+            if len(processed_rows) != len(rows):
+                logger.warning("Duplicate row IDs skipped in section '%s'", section["title"])
+            if processed_rows:
+                 processed_sections.append({"title": section["title"], "rows": processed_rows})
+
+    if not row_ids:
         logger.error("Cannot create list payload with no valid sections/rows.")
         return create_text_payload(recipient_number, "Sorry, there was an error preparing the list.")
 
 
     return {
-        "messages": [{
-            "clientWaNumber": recipient_number,
-            "messageType": "interactive",
-            "interactive": {
-                "type": "list",
-                "header": {
-                    "type": "text",
-                    "text": header_text
-                },
-                "body": {
-                    "text": body_text
-                },
-                "action": {
-                    "button": button_text,
-                    "sections": processed_sections
-                }
+        "clientWaNumber": recipient_number,
+        "messageType": "interactive",
+        "interactive": {
+            "type": "list",
+            "header": {
+                "type": "text",
+                "text": header_text
+            },
+            "body": {
+                "text": body_text
+            },
+            "action": {
+                "button": button_text,
+                "sections": processed_sections
             }
-        }]
+        }
     }
 
-def send_whatsapp_message(payload):
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {WHATSAPP_API_TOKEN}"
-    }
-    recipient = payload.get("messages", [{}])[0].get("clientWaNumber", "unknown")
+RECIPIENT_PLACEHOLDER = "__WA_RECIPIENT__"
+
+def build_message_template(message):
+    # Encodes a message addressed to RECIPIENT_PLACEHOLDER once, split around the recipient
+    prefix, suffix = _dumps(message).split(_dumps(RECIPIENT_PLACEHOLDER))
+    return (prefix, suffix)
+
+def render_message_template(template, recipient_number):
+    prefix, suffix = template
+    return prefix + _dumps(recipient_number) + suffix
+
+# Static button replies are the same for every user, so they are encoded only once
+GREETING_MENU_TEMPLATE = build_message_template(create_button_payload(
+    RECIPIENT_PLACEHOLDER, "I'm here to assist you. Please choose an option:", MENU_BUTTONS))
+INVALID_MENU_TEMPLATE = build_message_template(create_button_payload(
+    RECIPIENT_PLACEHOLDER, "Invalid selection. Please choose an option:", MENU_BUTTONS))
+RETURN_MENU_TEMPLATE = build_message_template(create_button_payload(
+    RECIPIENT_PLACEHOLDER, "Okay. How else can I help you?", MENU_BUTTONS))
+FOLLOWUP_PROMPT_TEMPLATE = build_message_template(create_button_payload(
+    RECIPIENT_PLACEHOLDER, "Please choose 'Place Order' or 'Back to Menu'.", FOLLOWUP_BUTTONS))
+PRODUCT_LIST_TEMPLATE = build_message_template(create_list_payload(
+    RECIPIENT_PLACEHOLDER, "Product Catalog", "Select a product to learn more.", "View Products", PRODUCT_SECTIONS))
+ORDER_CONFIRMED_IMAGE_TEMPLATE = build_message_template(create_media_payload(
+    recipient_number=RECIPIENT_PLACEHOLDER,
+    media_type="image",
+    media_url="https://imgs.search.brave.com/vcJgDQviE0Vle5o55uI7pg3HQvGiIDzrQYHXM0-VE7o/rs:fit:500:0:0:0/g:ce/aHR0cHM6Ly90aHVt/YnMuZHJlYW1zdGlt/ZS5jb20vYi9vcmRl/ci1wbGFjZWQtZS1j/b21tZXJjZS1tb2Rl/bC1vbmxpbmUtc3Rv/cmUtZGVsaXZlcnkt/Ym9va2luZy1wcm9j/ZXNzLW9yZGVyLXBs/YWNlZC1jb3VyaWVy/LXNlcnZpY2Utc2hp/cHBpbmctY29uZGl0/aW9ucy1wdXJjaGFz/ZS1tYWRlLTI3NDQ1/NjY2NS5qcGc",
+    file_name="order_success.png",
+    mime_type="image/png"
+))
+
+# Replies that never change are shared tuples; callers only read them
+REPLY_WELCOME = ("text", {"message_text": "Hello! Welcome to our service. How can I help you today?"})
+REPLY_ASK_SUPPORT = ("text", {"message_text": "Please describe the issue you're experiencing."})
+REPLY_ASK_ORDER = ("text", {"message_text": "Which product would you like to order and the quantity? (e.g., 'Model A 2')"})
+REPLY_UNKNOWN_PRODUCT = ("text", {"message_text": "Sorry, I didn't understand that selection. Let's start over."})
+REPLY_SUPPORT_RECEIVED = ("text", {"message_text": "Thank you. Our support team has received your request and will review the issue. We'll get back to you soon."})
+REPLY_ASK_SUPPORT_AGAIN = ("text", {"message_text": "Please describe the issue you are facing."})
+REPLY_ORDER_NOT_UNDERSTOOD = ("text", {"message_text": "Sorry, I couldn't understand that. Please provide the product name and quantity (e.g., 'Model B 3')."})
+REPLY_ASK_ORDER_AGAIN = ("text", {"message_text": "Please tell me the product and quantity you want to order."})
+REPLY_ASK_QTY_VALID = ("text", {"message_text": "Please enter a valid number for the quantity."})
+REPLY_ASK_ADDRESS = ("text", {"message_text": "Please provide the delivery address."})
+REPLY_RESET = ("text", {"message_text": "Sorry, something went wrong. Let's start over. How can I help?"})
+REPLY_GREETING_MENU = ("template", {"template": GREETING_MENU_TEMPLATE})
+REPLY_INVALID_MENU = ("template", {"template": INVALID_MENU_TEMPLATE})
+REPLY_RETURN_MENU = ("template", {"template": RETURN_MENU_TEMPLATE})
+REPLY_FOLLOWUP_PROMPT = ("template", {"template": FOLLOWUP_PROMPT_TEMPLATE})
+REPLY_PRODUCT_LIST = ("template", {"template": PRODUCT_LIST_TEMPLATE})
+REPLY_ORDER_CONFIRMED_IMAGE = ("template", {"template": ORDER_CONFIRMED_IMAGE_TEMPLATE})
+# Product id -> "order this?" follow-up; the catalog is static, so each one is encoded once too
+PRODUCT_FOLLOWUP_REPLIES = {
+    row["id"]: ("template", {"template": build_message_template(create_button_payload(
+        RECIPIENT_PLACEHOLDER,
+        f"{PRODUCTS[row['id']]}\n\nWould you like to place an order for {row['title']}?",
+        FOLLOWUP_BUTTONS))})
+    for section in PRODUCT_SECTIONS for row in section["rows"]
+}
+
+# Main menu button id -> (next state, reply)
+MENU_ACTIONS = {
+    'menu_product_info': ("product_info_list", REPLY_PRODUCT_LIST),
+    'menu_support': ("support_request", REPLY_ASK_SUPPORT),
+    'menu_order': ("order_start", REPLY_ASK_ORDER)
+}
+
+# Reply type -> message builder; reply data keys are the builder's keyword arguments
+MESSAGE_BUILDERS = {
+    "text": create_text_payload,
+    "media": create_media_payload,
+    "button": create_button_payload,
+    "template": render_message_template,
+    "list": create_list_payload,
+    "contact": create_contact_payload
+}
+
+def encode_messages(messages):
+    # Messages rendered from a template are already bytes and are spliced in as-is
+    return b'{"messages":[' + b",".join(
+        message if isinstance(message, bytes) else _dumps(message) for message in messages) + b"]}"
+
+def send_whatsapp_message(body, recipient, message_count=1):
+    SEND_RATE_LIMITER.acquire(message_count)
     try:
-        response = requests.post(WHATSAPP_API_URL, headers=headers, data=json.dumps(payload))
+        response = SESSION.post(WHATSAPP_API_URL, data=body, timeout=WHATSAPP_API_TIMEOUT)
         response.raise_for_status()
-        logger.info(f"Message sent to {recipient}. Status Code: {response.status_code}, Response: {response.text}")
+        logger.info("Message sent to %s. Status Code: %d", recipient, response.status_code)
         return {"status": "success", "statusCode": response.status_code}
+    except requests.exceptions.Timeout as e:
+        # Expected now and then when Heltar is slow; kept below ERROR so alerts track real failures
+        logger.warning("Timed out sending WhatsApp message to %s: %s", recipient, e)
+        return {"status": "error", "message": str(e)}
     except requests.exceptions.RequestException as e:
-        logger.error(f"Error sending WhatsApp message to {recipient}: {str(e)}")
-        if e.response is not None:
-            logger.error(f"Heltar Response Body: {e.response.text}")
+        logger.error("Error sending WhatsApp message to %s: %s", recipient, e)
+        # Decoding the body is only worth it when someone is reading debug output
+        if e.response is not None and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Heltar Response Body: %s", e.response.text)
         return {"status": "error", "message": str(e)}
     except Exception as e:
-        logger.error(f"Unexpected error sending WhatsApp message to {recipient}: {str(e)}")
+        logger.error("Unexpected error sending WhatsApp message to %s: %s", recipient, e)
         return {"status": "error", "message": str(e)}
 
-def process_message(sender_id, message_text=None, interactive_reply=None):
-    now = datetime.now()
-
-    # !! Replace user_sessions interaction with Redis below !!
-    if sender_id not in user_sessions:
-        user_sessions[sender_id] = {
-            "session_id": str(uuid.uuid4()),
-            "created_at": now.isoformat(), # Use ISO format for JSON compatibility
-            "last_interaction": now.isoformat(),
+def submit_whatsapp_messages(outbox):
+    # outbox holds (recipient, message) pairs. Heltar accepts many messages per request, but a rejected
+    # request fails all of them, so each recipient gets its own requests
+    by_recipient = {}
+    for recipient_number, message in outbox:
+        by_recipient.setdefault(recipient_number, []).append(message)
+
+    for recipient, messages in by_recipient.items():
+        for start in range(0, len(messages), MAX_MESSAGES_PER_REQUEST):
+            batch = messages[start:start + MAX_MESSAGES_PER_REQUEST]
+            body = encode_messages(batch)
+            if PROCESS_INLINE:
+                send_whatsapp_message(body, recipient, len(batch))
+                continue
+            try:
+                EXECUTOR.submit(send_whatsapp_message, body, recipient, len(batch))
+            except RuntimeError:
+                # The executor takes no new work once the interpreter is exiting; send from this thread
+                send_whatsapp_message(body, recipient, len(batch))
+
+def session_key(sender_id):
+    return f"sess:{sender_id}"
+
+def load_session(sender_id, now=None):
+    if rds is None:
+        session = user_sessions.get(sender_id)
+        if session is None:
+            return None
+        if (now or time.time()) - session["last_interaction"] > SESSION_TTL_SECONDS:
+            del user_sessions[sender_id]
+            return None
+        user_sessions.move_to_end(sender_id)
+        return session
+
+    session = rds.hgetall(session_key(sender_id))
+    if not session:
+        return None
+    session["context"] = _loads(session.get("context") or "{}")
+    return session
+
+def save_session(sender_id, session, fields=None):
+    if rds is None:
+        user_sessions[sender_id] = session
+        user_sessions.move_to_end(sender_id)
+        while len(user_sessions) > MAX_IN_MEMORY_SESSIONS:
+            user_sessions.popitem(last=False)
+        return
+
+    # Only the listed fields are written back; a new session writes all of them
+    fields = fields or session.keys()
+    mapping = {field: session[field] for field in fields}
+    if "context" in mapping:
+        mapping["context"] = _dumps(mapping["context"])
+    key = session_key(sender_id)
+    with rds.pipeline() as pipe:
+        pipe.hset(key, mapping=mapping)
+        pipe.expire(key, SESSION_TTL_SECONDS)
+        pipe.execute()
+
+def process_message(sender_id, message_text=None, interactive_reply=None, now=None):
+    now = now or int(time.time()) # Whole epoch seconds; format only where a human reads it
+
+    session = load_session(sender_id, now)
+    if session is None:
+        session = {
+            "session_id": os.urandom(16).hex(),
+            "created_at": now,
+            "last_interaction": now,
             "conversation_state": "greeting",
             "context": {}
         }
-        return ("text", {"message_text": "Hello! Welcome to our service. How can I help you today?"})
+        save_session(sender_id, session)
+        return REPLY_WELCOME
+
+    session["last_interaction"] = now
+    response = advance_conversation(sender_id, session, message_text, interactive_reply)
+    save_session(sender_id, session, fields=("conversation_state", "context", "last_interaction"))
+    return response
+
+def _handle_greeting(sender_id, session, message_text, reply_id, reply_title):
+    session["conversation_state"] = "menu"
+    return REPLY_GREETING_MENU
+
+def _handle_menu(sender_id, session, message_text, reply_id, reply_title):
+    action = MENU_ACTIONS.get(reply_id)
+    if action is None:
+        return REPLY_INVALID_MENU
+    next_state, reply = action
+    session["conversation_state"] = next_state
+    return reply
+
+def _handle_product_info_list(sender_id, session, message_text, reply_id, reply_title):
+    context = session["context"]
+    reply = PRODUCT_FOLLOWUP_REPLIES.get(reply_id)
+    if reply:
+        context["product_interest"] = reply_id
+        context["product_interest_title"] = reply_title
+        session["conversation_state"] = "product_followup"
+        return reply
     else:
-         user_sessions[sender_id]["last_interaction"] = now.isoformat()
+        session["conversation_state"] = "greeting"
+        return REPLY_UNKNOWN_PRODUCT
 
-    session = user_sessions[sender_id]
-    state = session["conversation_state"]
+def _handle_product_followup(sender_id, session, message_text, reply_id, reply_title):
     context = session["context"]
+    if reply_id == 'prod_order_yes':
+        session["conversation_state"] = "order_quantity"
+        product_name = context.get("product_interest_title", "the selected product")
+        return ("text", {"message_text": f"Great! How many units of {product_name} would you like?"})
+    elif reply_id == 'prod_order_no':
+        session["conversation_state"] = "menu"
+        return REPLY_RETURN_MENU
+    else:
+        return REPLY_FOLLOWUP_PROMPT
 
-    reply_id = interactive_reply.get('id') if interactive_reply else None
-    reply_title = interactive_reply.get('title') if interactive_reply else None
+def _handle_support_request(sender_id, session, message_text, reply_id, reply_title):
+    context = session["context"]
+    if message_text:
+        context["support_issue"] = message_text
+        session["conversation_state"] = "support_processing"
+        return REPLY_SUPPORT_RECEIVED
+    else:
+        return REPLY_ASK_SUPPORT_AGAIN
 
-    logger.info(f"Processing for {sender_id}: State='{state}', Text='{message_text}', ReplyID='{reply_id}'")
+def _handle_order_start(sender_id, session, message_text, reply_id, reply_title):
+    context = session["context"]
+    if message_text:
+        match = ORDER_RE.match(message_text)
+        quantity = int(match['qty']) if match else None
+        product_name = match['name'] if match else None
+
+        if quantity and quantity > 0 and product_name:
+            context["order_product"] = product_name
+            context["order_quantity"] = quantity
+            session["conversation_state"] = "order_address"
+            return ("text", {"message_text": f"Okay, {quantity} of {product_name}. Please provide your delivery address."})
+        else:
+            return REPLY_ORDER_NOT_UNDERSTOOD
+    else:
+        return REPLY_ASK_ORDER_AGAIN
+
+def _handle_order_quantity(sender_id, session, message_text, reply_id, reply_title):
+    context = session["context"]
+    match = QTY_RE.match(message_text) if message_text else None
+    quantity = int(match['qty']) if match else 0
+
+    if quantity > 0:
+        context["order_quantity"] = quantity
+        session["conversation_state"] = "order_address"
+        product_name = context.get("product_interest_title", "the selected product")
+        return ("text", {"message_text": f"Okay, {quantity} of {product_name}. Please provide your delivery address."})
+    else:
+        return REPLY_ASK_QTY_VALID
+
+def _handle_order_address(sender_id, session, message_text, reply_id, reply_title):
+    context = session["context"]
+    if message_text:
+        context["delivery_address"] = message_text
+        session["conversation_state"] = "order_complete"
+        product = context.get("product_interest_title") or context.get("order_product", "Unknown Product")
+        quantity = context.get("order_quantity", "N/A")
+        address = context.get("delivery_address", "N/A")
+        logger.info("Order Placed: User=%s, Product=%s, Qty=%s, Address=%s", sender_id, product, quantity, address)
+
+        context.pop("order_product", None)
+        context.pop("order_quantity", None)
+        context.pop("delivery_address", None)
+        context.pop("product_interest", None)
+        context.pop("product_interest_title", None)
 
-    if state == "greeting":
         session["conversation_state"] = "menu"
-        menu_buttons = [
-            {'id': 'menu_product_info', 'title': 'Product Information'},
-            {'id': 'menu_support', 'title': 'Customer Support'},
-            {'id': 'menu_order', 'title': 'Place an Order'}
-            # 4th button removed
-        ]
-        return ("button", {
-            "body_text": "I'm here to assist you. Please choose an option:",
-            "buttons": menu_buttons
-        })
-
-    elif state == "menu":
-        if reply_id == 'menu_product_info':
-            session["conversation_state"] = "product_info_list"
-            product_sections = [{
-                 "title": "Our Products",
-                 "rows": [
-                     {'id': 'prod_A', 'title': 'Model A', 'description': 'High-end model - $299'},
-                     {'id': 'prod_B', 'title': 'Model B', 'description': 'Mid-range model - $199'},
-                     {'id': 'prod_C', 'title': 'Model C', 'description': 'Budget model - $99'}
-                 ]
-            }]
-            return ("list", {
-                "header_text": "Product Catalog",
-                "body_text": "Select a product to learn more.",
-                "button_text": "View Products",
-                "sections": product_sections
-            })
-        elif reply_id == 'menu_support':
-            session["conversation_state"] = "support_request"
-            return ("text", {"message_text": "Please describe the issue you're experiencing."})
-        elif reply_id == 'menu_order':
-            session["conversation_state"] = "order_start"
-            return ("text", {"message_text": "Which product would you like to order and the quantity? (e.g., 'Model A 2')"})
-        # Removed contact option handling
-        else:
-            menu_buttons = [
-                {'id': 'menu_product_info', 'title': 'Product Information'},
-                {'id': 'menu_support', 'title': 'Customer Support'},
-                {'id': 'menu_order', 'title': 'Place an Order'}
-            ]
-            return ("button", {
-                "body_text": "Invalid selection. Please choose an option:",
-                "buttons": menu_buttons
-            })
-
-    elif state == "product_info_list":
-        products = {"prod_A": "Model A - $299", "prod_B": "Model B - $199", "prod_C": "Model C - $99"}
-        if reply_id in products:
-            product_desc = products[reply_id]
-            context["product_interest"] = reply_id
-            context["product_interest_title"] = reply_title
-            session["conversation_state"] = "product_followup"
-            followup_buttons = [
-                {'id': 'prod_order_yes', 'title': 'Place Order'},
-                {'id': 'prod_order_no', 'title': 'Back to Menu'}
-            ]
-            return ("button", {
-                "body_text": f"{product_desc}\n\nWould you like to place an order for {reply_title}?",
-                "buttons": followup_buttons
-            })
-        else:
-            session["conversation_state"] = "greeting"
-            return ("text", {"message_text": "Sorry, I didn't understand that selection. Let's start over."})
-
-    elif state == "product_followup":
-         if reply_id == 'prod_order_yes':
-             session["conversation_state"] = "order_quantity"
-             product_name = context.get("product_interest_title", "the selected product")
-             return ("text", {"message_text": f"Great! How many units of {product_name} would you like?"})
-         elif reply_id == 'prod_order_no':
-             session["conversation_state"] = "menu"
-             menu_buttons = [
-                 {'id': 'menu_product_info', 'title': 'Product Information'},
-                 {'id': 'menu_support', 'title': 'Customer Support'},
-                 {'id': 'menu_order', 'title': 'Place an Order'}
-             ]
-             return ("button", {
-                "body_text": "Okay. How else can I help you?",
-                "buttons": menu_buttons
-            })
-         else:
-             followup_buttons = [
-                {'id': 'prod_order_yes', 'title': 'Place Order'},
-                {'id': 'prod_order_no', 'title': 'Back to Menu'}
-             ]
-             return ("button", {
-                "body_text": "Please choose 'Place Order' or 'Back to Menu'.",
-                "buttons": followup_buttons
-            })
-
-    elif state == "support_request":
-        if message_text:
-            context["support_issue"] = message_text
-            session["conversation_state"] = "support_processing"
-            return ("text", {"message_text": "Thank you. Our support team has received your request and will review the issue. We'll get back to you soon."})
-        else:
-             return ("text", {"message_text": "Please describe the issue you are facing."})
+        # The image goes out first, in the same request as the confirmation buttons
+        return [REPLY_ORDER_CONFIRMED_IMAGE, ("button", {
+            "header_text": "Order Confirmed!",
+            "body_text": f"Thank you! Your order for {quantity} x {product} has been placed.\n\nIs there anything else?",
+            "buttons": MENU_BUTTONS
+        })]
+    else:
+        return REPLY_ASK_ADDRESS
+
+def _handle_unknown_state(sender_id, session, message_text, reply_id, reply_title):
+    logger.warning("Unhandled state '%s' or situation for user %s. Resetting.", session['conversation_state'], sender_id)
+    session["conversation_state"] = "greeting"
+    return REPLY_RESET
+
+STATE_HANDLERS = {
+    "greeting": _handle_greeting,
+    "menu": _handle_menu,
+    "product_info_list": _handle_product_info_list,
+    "product_followup": _handle_product_followup,
+    "support_request": _handle_support_request,
+    "order_start": _handle_order_start,
+    "order_quantity": _handle_order_quantity,
+    "order_address": _handle_order_address
+}
+
+def advance_conversation(sender_id, session, message_text=None, interactive_reply=None):
+    state = session["conversation_state"]
 
-    elif state == "order_start":
-        if message_text:
-            parts = message_text.split()
-            quantity = None
-            product_name = None
+    reply_id = interactive_reply.get('id') if interactive_reply else None
+    reply_title = interactive_reply.get('title') if interactive_reply else None
+
+    logger.info("Processing for %s: State='%s', Text='%s', ReplyID='%s'", sender_id, state, message_text, reply_id)
+
+    handler = STATE_HANDLERS.get(state, _handle_unknown_state)
+    return handler(sender_id, session, message_text, reply_id, reply_title)
+
+def iter_messages(data):
+    # Walks entry -> changes -> value -> messages without allocating defaults for missing keys
+    for entry in data.get('entry') or ():
+        for change in entry.get('changes') or ():
+            for message in (change.get('value') or {}).get('messages') or ():
+                yield message
+
+def handle_message(message, now, outbox):
+    sender_id = message.get('from')
+    message_type = message.get('type')
+    message_text = None
+    interactive_reply = None
+
+    if not sender_id:
+        logger.warning("Message received without sender ID.")
+        return
+
+    if message_type == 'text':
+        message_text = message.get('text', {}).get('body')
+    elif message_type == 'interactive':
+        interactive = message.get('interactive', {})
+        interaction_type = interactive.get('type')
+        if interaction_type not in INTERACTIVE_TYPES:
+            logger.warning("Received unknown interactive type: %s", interaction_type)
+            return
+        interactive_reply = interactive.get(interaction_type)
+        if not isinstance(interactive_reply, dict):
+            logger.warning("Interactive %s from %s has no reply object. Ignoring.", interaction_type, sender_id)
+            return
+        logger.info("Interactive reply from %s: Type='%s', ID='%s', Title='%s'",
+                    sender_id, interaction_type, interactive_reply.get('id'), interactive_reply.get('title'))
+    else:
+        logger.info("Received non-text/interactive message type '%s' from %s. Ignoring.", message_type, sender_id)
+        # Optionally send a message saying you only understand text/buttons
+        # outbox.append((sender_id, create_text_payload(sender_id, "Sorry, I can currently only understand text messages and interactive replies.")))
+        return
+
+    if not (message_text or interactive_reply):
+        logger.info("No actionable input (text/interactive) from %s.", sender_id)
+        return
+
+    replies = process_message(sender_id, message_text, interactive_reply, now)
+
+    # Handlers return one reply, or a list of replies to send in order
+    for response_type, response_data in (replies if isinstance(replies, list) else (replies,)):
+        if response_type == 'none':
+            logger.info("No response generated for user %s", sender_id)
+            continue
+
+        builder = MESSAGE_BUILDERS.get(response_type)
+        outgoing = None
+        if builder:
             try:
-                if parts[-1].isdigit():
-                    quantity = int(parts[-1])
-                    product_name = " ".join(parts[:-1])
-                else:
-                     product_name = message_text
-            except:
-                pass
-
-            if quantity and quantity > 0 and product_name:
-                 context["order_product"] = product_name
-                 context["order_quantity"] = quantity
-                 session["conversation_state"] = "order_address"
-                 return ("text", {"message_text": f"Okay, {quantity} of {product_name}. Please provide your delivery address."})
-            else:
-                 return ("text", {"message_text": "Sorry, I couldn't understand that. Please provide the product name and quantity (e.g., 'Model B 3')."})
+                outgoing = builder(recipient_number=sender_id, **response_data)
+            except Exception as e:
+                logger.error("Failed to build '%s' reply for %s: %s", response_type, sender_id, e,
+                             exc_info=logger.isEnabledFor(logging.DEBUG))
         else:
-             return ("text", {"message_text": "Please tell me the product and quantity you want to order."})
-
-
-    elif state == "order_quantity":
-         if message_text and message_text.isdigit() and int(message_text) > 0:
-             context["order_quantity"] = int(message_text)
-             session["conversation_state"] = "order_address"
-             product_name = context.get("product_interest_title", "the selected product")
-             return ("text", {"message_text": f"Okay, {context['order_quantity']} of {product_name}. Please provide your delivery address."})
-         else:
-             return ("text", {"message_text": "Please enter a valid number for the quantity."})
-
-    elif state == "order_address":
-        if message_text:
-            context["delivery_address"] = message_text
-            session["conversation_state"] = "order_complete"
-            product = context.get("product_interest_title") or context.get("order_product", "Unknown Product")
-            quantity = context.get("order_quantity", "N/A")
-            address = context.get("delivery_address", "N/A")
-            logger.info(f"Order Placed: User={sender_id}, Product={product}, Qty={quantity}, Address={address}")
-
-            context.pop("order_product", None)
-            context.pop("order_quantity", None)
-            context.pop("delivery_address", None)
-            context.pop("product_interest", None)
-            context.pop("product_interest_title", None)
-
-            image_payload = create_media_payload(
-                recipient_number=sender_id,
-                media_type="image",
-                media_url="https://imgs.search.brave.com/vcJgDQviE0Vle5o55uI7pg3HQvGiIDzrQYHXM0-VE7o/rs:fit:500:0:0:0/g:ce/aHR0cHM6Ly90aHVt/YnMuZHJlYW1zdGlt/ZS5jb20vYi9vcmRl/ci1wbGFjZWQtZS1j/b21tZXJjZS1tb2Rl/bC1vbmxpbmUtc3Rv/cmUtZGVsaXZlcnkt/Ym9va2luZy1wcm9j/ZXNzLW9yZGVyLXBs/YWNlZC1jb3VyaWVy/LXNlcnZpY2Utc2hp/cHBpbmctY29uZGl0/aW9ucy1wdXJjaGFz/ZS1tYWRlLTI3NDQ1/NjY2NS5qcGc",
-                file_name="order_success.png",
-                mime_type="image/png"
-                
-            )
-
-            send_whatsapp_message(image_payload)
-
-            session["conversation_state"] = "menu"
-            menu_buttons = [
-                 {'id': 'menu_product_info', 'title': 'Product Information'},
-                 {'id': 'menu_support', 'title': 'Customer Support'},
-                 {'id': 'menu_order', 'title': 'Place an Order'}
-             ]
-            return ("button", {
-                 "header_text": "Order Confirmed!",
-                 "body_text": f"Thank you! Your order for {quantity} x {product} has been placed.\n\nIs there anything else?",
-                 "buttons": menu_buttons
-             })
-        else:
-             return ("text", {"message_text": "Please provide the delivery address."})
+            logger.error("Unknown response type '%s' from process_message.", response_type)
+        if outgoing is None:
+            outgoing = create_text_payload(sender_id, "Sorry, an internal error occurred.")
+        outbox.append((sender_id, outgoing))
 
-    # !! This final part of process_message needs to save the session back to Redis !!
-    # For now, it just returns the fallback for the in-memory version
-    logger.warning(f"Unhandled state '{state}' or situation for user {sender_id}. Resetting.")
-    session["conversation_state"] = "greeting"
-    return ("text", {"message_text": "Sorry, something went wrong. Let's start over. How can I help?"})
+def handle_webhook_data(data, outbox):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Received webhook data: %s", _dumps(data).decode())
+
+    now = int(time.time()) # One clock read shared by every message in this delivery
 
+    for message in iter_messages(data):
+        # One bad message, from parsing to building its reply, must not drop the rest of the delivery
+        try:
+            handle_message(message, now, outbox)
+        except Exception as e:
+            sender_id = message.get('from') if isinstance(message, dict) else None
+            logger.error("Error processing message from %s: %s", sender_id, e,
+                         exc_info=logger.isEnabledFor(logging.DEBUG))
+
+def process_deliveries(deliveries):
+    for data in deliveries:
+        # Each delivery's replies go out as soon as it is handled, without waiting on the others
+        outbox = []
+        try:
+            handle_webhook_data(data, outbox)
+        except Exception as e:
+            logger.error("Error processing webhook data: %s", e, exc_info=True)
+        if outbox:
+            submit_whatsapp_messages(outbox)
+
+def drain_webhook_queue():
+    while True:
+        data = WEBHOOK_QUEUE.get()
+        if data is WORKER_STOP:
+            return
+        process_deliveries((data,))
+
+# Elsewhere webhook bodies are processed after the response by a single worker, in arrival order
+WEBHOOK_QUEUE = queue.SimpleQueue()
+WORKER_STOP = object()
+WORKER_STOP_TIMEOUT = 20 # seconds; stays under gunicorn's default 30s graceful_timeout
+# Every accepted webhook gets the same ack, so it is encoded once
+OK_RESPONSE = (_dumps({"status": "success"}), 200, {"Content-Type": "application/json"})
+webhook_worker = None
+
+def start_webhook_worker():
+    global webhook_worker
+    webhook_worker = threading.Thread(target=drain_webhook_queue, name="webhook-worker", daemon=True)
+    webhook_worker.start()
+
+def stop_webhook_worker():
+    # Deliveries already acked must not vanish on shutdown; they are handled before the executor stops
+    WEBHOOK_QUEUE.put(WORKER_STOP)
+    webhook_worker.join(WORKER_STOP_TIMEOUT)
+    if webhook_worker.is_alive():
+        logger.error("Webhook worker did not finish within %ss; about %d deliveries were dropped",
+                     WORKER_STOP_TIMEOUT, WEBHOOK_QUEUE.qsize())
+
+# Threads do not survive fork, so this module must be imported in the process that serves it:
+# the dev server, or gunicorn with preload_app = False as in gunicorn.conf.py
+if not PROCESS_INLINE:
+    start_webhook_worker()
+    # Registered after EXECUTOR.shutdown, so it runs before it (atexit is last in, first out)
+    atexit.register(stop_webhook_worker)
 
 @app.route('/')
 def home():
@@ -377,100 +711,48 @@ def home():
 def webhook():
     if request.method == 'POST':
         try:
-            data = request.json
-            logger.info(f"Received webhook data: {json.dumps(data, indent=2)}")
-
-            if 'entry' in data:
-                for entry in data.get('entry', []):
-                    for change in entry.get('changes', []):
-                        value = change.get('value', {})
-                        if 'messages' in value:
-                            for message in value.get('messages', []):
-                                sender_id = message.get('from')
-                                message_type = message.get('type')
-                                message_text = None
-                                interactive_reply = None
-
-                                if not sender_id:
-                                    logger.warning("Message received without sender ID.")
-                                    continue
-
-                                if message_type == 'text':
-                                    message_text = message.get('text', {}).get('body')
-                                elif message_type == 'interactive':
-                                    interactive = message.get('interactive', {})
-                                    interaction_type = interactive.get('type')
-                                    if interaction_type in ['button_reply', 'list_reply']:
-                                        interactive_reply = interactive.get(interaction_type)
-                                        logger.info(f"Interactive reply from {sender_id}: Type='{interaction_type}', ID='{interactive_reply.get('id')}', Title='{interactive_reply.get('title')}'")
-                                    else:
-                                        logger.warning(f"Received unknown interactive type: {interaction_type}")
-                                        continue
-                                else:
-                                    logger.info(f"Received non-text/interactive message type '{message_type}' from {sender_id}. Ignoring.")
-                                    # Optionally send a message saying you only understand text/buttons
-                                    # payload = create_text_payload(sender_id, "Sorry, I can currently only understand text messages and interactive replies.")
-                                    # send_whatsapp_message(payload)
-                                    continue
-
-
-                                if message_text or interactive_reply:
-                                    # !! process_message will need changes for Redis !!
-                                    response_type, response_data = process_message(sender_id, message_text, interactive_reply)
-
-                                    payload = None
-                                    if response_type == 'text':
-                                        payload = create_text_payload(sender_id, response_data['message_text'])
-                                    elif response_type == 'media':
-                                        payload = create_media_payload(sender_id,
-                                                                        response_data['media_type'],
-                                                                        response_data['media_url'],
-                                                                        response_data['file_name'],
-                                                                        response_data['mime_type'])
-                                    elif response_type == 'button':
-                                        payload = create_button_payload(sender_id,
-                                                                        response_data['body_text'],
-                                                                        response_data['buttons'],
-                                                                        response_data.get('header_text'),
-                                                                        response_data.get('header_media'))
-                                    elif response_type == 'list':
-                                         payload = create_list_payload(sender_id,
-                                                                         response_data['header_text'],
-                                                                         response_data['body_text'],
-                                                                         response_data['button_text'],
-                                                                         response_data['sections'])
-                                    elif response_type == 'contact':
-                                         payload = create_contact_payload(sender_id,
-                                                                          response_data['formatted_name'],
-                                                                          response_data['phone_wa_id'],
-                                                                          response_data.get('prefix'))
-                                    elif response_type == 'none':
-                                        logger.info(f"No response generated for user {sender_id}")
-                                        pass
-                                    else:
-                                         logger.error(f"Unknown response type '{response_type}' from process_message.")
-                                         payload = create_text_payload(sender_id, "Sorry, an internal error occurred.")
-
-                                    if payload:
-                                        send_whatsapp_message(payload)
-                                else:
-                                     logger.info(f"No actionable input (text/interactive) from {sender_id}.")
-
-
-            return jsonify({"status": "success"}), 200
-        except Exception as e:
-            logger.error(f"Error processing webhook POST request: {str(e)}", exc_info=True)
-            return jsonify({"status": "error", "message": str(e)}), 500
+            data = _loads(request.get_data(cache=False))
+        except ValueError as e: # Every codec's decode error subclasses ValueError
+            logger.warning("Invalid JSON in webhook POST request: %s", e)
+            return jsonify({"status": "error", "message": "Invalid JSON payload"}), 400
+
+        # Status-only deliveries (sent/delivered/read receipts) need no work at all
+        try:
+            has_messages = isinstance(data, dict) and next(iter_messages(data), None) is not None
+        except (AttributeError, TypeError) as e: # A level of the entry tree is not an object/list
+            logger.warning("Malformed webhook payload: %s", e)
+            return jsonify({"status": "error", "message": "Invalid JSON payload"}), 400
+        if not has_messages:
+            return OK_RESPONSE
+
+        if PROCESS_INLINE:
+            process_deliveries((data,))
+            return OK_RESPONSE
+
+        # Acknowledge right away; the worker thread runs the conversation logic
+        WEBHOOK_QUEUE.put(data)
+        return OK_RESPONSE
+
+_status_body = (0, b"")
+
+def status_body():
+    # Health checks poll far more often than once a second, so the body is encoded once per second
+    global _status_body
+    second = int(time.time())
+    if second != _status_body[0]:
+        _status_body = (second, _dumps({
+            "status": "active",
+            "warning": "Session count requires Redis query for accuracy on serverless.",
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(second))
+        }))
+    return _status_body[1]
 
 @app.route('/status', methods=['GET'])
 def status():
-    # This route would need to query Redis for active sessions if that metric is needed
-    return jsonify({
-        "status": "active",
-        "warning": "Session count requires Redis query for accuracy on serverless.",
-        "timestamp": datetime.now().isoformat()
-    })
+    # Counting active sessions would need a Redis SCAN over sess:* keys, so it is not reported here
+    return status_body(), 200, {"Content-Type": "application/json"}
 
+# Local development only; production runs under gunicorn (see gunicorn.conf.py)
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file